@@ -0,0 +1,84 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# Ahead-of-time compiled update of the circular Nagel-Schreckenberg model, for use 
+# without Numba. Build it with build_ns_kernel.py.
+
+
+import numpy as np
+
+from libc.stdint cimport uint64_t
+
+
+cdef inline uint64_t _splitmix64(uint64_t *s) noexcept nogil:
+    """
+    Advance the splitmix64 generator in s and return its next 64-bit output.
+    """
+    s[0] += 0x9E3779B97F4A7C15ULL
+    cdef uint64_t z = s[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline double _next_u01(uint64_t *s) noexcept nogil:
+    """
+    A uniform random number in [0, 1) from the top 53 bits of the generator.
+    """
+    return (_splitmix64(s) >> 11) * (1.0 / 9007199254740992.0)
+
+
+cpdef next_state_circular(signed char[::1] state, int v_max, double p, unsigned long long seed):
+    """
+    Compute the next state of the circular, closed system and return it as a new int8
+    array, following the same rules as TrafficModelCircular.next_state. The random 
+    decceleration events are drawn from a generator seeded with seed.
+    """
+    cdef Py_ssize_t cells = state.shape[0]
+    next_state_arr = np.full(cells, -1, np.int8)
+    cdef signed char[::1] next_state = next_state_arr
+    cdef uint64_t rng = seed
+    cdef Py_ssize_t i, first = -1, idx, next_idx, gap, v
+
+    # Finding the first car, which the last car wraps around to
+    for i in range(cells):
+        if state[i] > -1:
+            first = i
+            break
+    if first == -1:
+        return next_state_arr
+
+    with nogil:
+        idx = first
+        while True:
+            # Finding the distance to the next car
+            next_idx = idx + 1
+            while next_idx < cells and state[next_idx] == -1:
+                next_idx += 1
+            if next_idx == cells:
+                gap = first + cells - idx
+            else:
+                gap = next_idx - idx
+
+            # Step 1: Acceleration
+            v = state[idx]
+            if v < v_max and v + 1 < gap:
+                v += 1
+
+            # Step 2: Slowing Down
+            if v >= gap:
+                v = gap - 1
+
+            # Step 3: Randomization
+            if _next_u01(&rng) < p and v > 0:
+                v -= 1
+
+            # Step 4: Car Motion
+            if idx + v >= cells:
+                next_state[idx + v - cells] = v
+            else:
+                next_state[idx + v] = v
+
+            if next_idx == cells:
+                break
+            idx = next_idx
+
+    return next_state_arr
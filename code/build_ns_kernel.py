@@ -0,0 +1,54 @@
+# Builds the ahead-of-time compiled kernel in _ns_kernel.pyx, which nsmodel.py uses
+# for the circular model when Numba isn't installed, optionally with profile-guided
+# optimization (PGO). From this directory:
+#
+#   python build_ns_kernel.py build_ext --inplace
+#
+# Setting NS_NATIVE=1 also tunes the build for this machine's CPU with -march=native,
+# so the result may not run on other machines and shouldn't be distributed.
+#
+# or, for a PGO build trained on a representative run:
+#
+#   NS_PGO=generate python build_ns_kernel.py build_ext --inplace --force
+#   python build_ns_kernel.py profile
+#   NS_PGO=use python build_ns_kernel.py build_ext --inplace --force
+
+
+import os
+import sys
+
+
+def profile(cells=1000, cars=200, n_steps=10000, seed=0):
+    """
+    Run the compiled kernel on a representative system to collect PGO profile data.
+    """
+    import numpy as np
+    from _ns_kernel import next_state_circular
+
+    rng = np.random.default_rng(seed)
+    state = np.full(cells, -1, np.int8)
+    state[rng.choice(cells, cars, replace=False)] = 0
+    for i in range(n_steps):
+        state = next_state_circular(state, 5, 0.5, i)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["profile"]:
+        profile()
+        sys.exit()
+
+    from setuptools import Extension, setup
+    from Cython.Build import cythonize
+
+    flags = ["-O3"]
+    if os.environ.get("NS_NATIVE") == "1":
+        flags.append("-march=native")
+    pgo = os.environ.get("NS_PGO")
+    if pgo == "generate":
+        flags.append("-fprofile-generate")
+    elif pgo == "use":
+        flags += ["-fprofile-use", "-fprofile-correction"]
+
+    extension = Extension("_ns_kernel", ["_ns_kernel.pyx"], extra_compile_args=flags, 
+                          extra_link_args=flags)
+    setup(name="_ns_kernel", ext_modules=cythonize([extension]), script_args=sys.argv[1:])
@@ -0,0 +1,134 @@
+# CUDA kernels for the dense Nagel-Schreckenberg update of a traffic ensemble.
+
+
+import numpy as np
+from numba import cuda
+from numba.cuda.random import create_xoroshiro128p_states, xoroshiro128p_uniform_float32
+
+
+# Number of cells handled by each block of GPU threads.
+THREADS_PER_BLOCK = 256
+
+# Number of timesteps collected on the GPU before each copy back to the host.
+HISTORY_CHUNK = 64
+
+
+@cuda.jit
+def _ns_velocity(v_in, v_new, rng_states, v_max, p):
+    """
+    Apply steps 1-3 of the NS model to every cell of every lane, with one thread per
+    cell. Empty cells stay at -1.
+    """
+    lane, i = cuda.grid(2)
+    lanes, cells = v_in.shape
+    if lane >= lanes or i >= cells:
+        return
+    if v_in[lane, i] < 0:
+        v_new[lane, i] = -1
+        return
+
+    # Finding the distance to the next car, only the first v_max + 1 cells matter
+    gap = 1
+    while gap <= v_max and v_in[lane, (i + gap) % cells] < 0:
+        gap += 1
+
+    # Steps 1 and 2: Acceleration and Slowing Down
+    v = min(v_in[lane, i] + 1, v_max, gap - 1)
+
+    # Step 3: Randomization
+    if xoroshiro128p_uniform_float32(rng_states, lane * cells + i) < p and v > 0:
+        v -= 1
+    v_new[lane, i] = v
+
+
+@cuda.jit
+def _ns_move(v_new, v_out, v_max):
+    """
+    Apply step 4 of the NS model, with one thread per cell. Each cell pulls in the
+    car that lands on it, which is the car k cells behind it moving at velocity k.
+    """
+    lane, i = cuda.grid(2)
+    lanes, cells = v_new.shape
+    if lane >= lanes or i >= cells:
+        return
+
+    v = -1
+    for k in range(v_max + 1):
+        if v_new[lane, (i - k + cells) % cells] == k:
+            v = k
+    v_out[lane, i] = v
+
+
+def create_rng_states(lanes, cells, seed):
+    """
+    Create one random number generator state on the GPU for every cell.
+    """
+    return create_xoroshiro128p_states(lanes * cells, seed=seed)
+
+
+def ns_step(v_in, v_out, v_new, rng_states, v_max, p, stream=0):
+    """
+    Compute the next state of every lane from the device array v_in into v_out, using
+    v_new as device scratch space of the same shape.
+    """
+    lanes, cells = v_in.shape
+    blocks = (lanes, (cells + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK)
+    threads = (1, THREADS_PER_BLOCK)
+    _ns_velocity[blocks, threads, stream](v_in, v_new, rng_states, v_max, p)
+    _ns_move[blocks, threads, stream](v_new, v_out, v_max)
+
+
+def simulate_gpu(state, n_steps, rng_states, v_max, p, history=None):
+    """
+    Iterate the ensemble state, with shape (lanes, cells), for n_steps on the GPU and
+    return the final state. If history is given, it must have shape
+    (n_steps + 1, lanes, cells) and receives every state. The states are collected
+    on the GPU and copied back every HISTORY_CHUNK steps, overlapping the copy with
+    the following steps.
+    """
+    compute = cuda.stream()
+    copy = cuda.stream()
+
+    # The chunks alternate, so one can be copied back while the other is filled.
+    d_chunks = [cuda.device_array((HISTORY_CHUNK,) + state.shape, np.int8, stream=compute)
+                for i in range(2)]
+    h_chunks = [cuda.pinned_array((HISTORY_CHUNK,) + state.shape, np.int8) for i in range(2)]
+    pending = [None, None]  # (copy event, first row of history) of each chunk
+
+    def flush(c):
+        if pending[c] is not None:
+            done, row = pending[c]
+            done.synchronize()
+            rows = min(HISTORY_CHUNK, n_steps + 1 - row)
+            history[row:row + rows] = h_chunks[c][:rows]
+            pending[c] = None
+
+    v_new = cuda.device_array(state.shape, np.int8, stream=compute)
+    d_chunks[0][0].copy_to_device(np.ascontiguousarray(state, np.int8), stream=compute)
+    for t in range(n_steps + 1):
+        c, row = divmod(t, HISTORY_CHUNK)
+        c %= 2
+        if row == 0 and t > 0:
+            flush(c)
+        if t > 0:
+            prev_c, prev_row = divmod(t - 1, HISTORY_CHUNK)
+            ns_step(d_chunks[prev_c % 2][prev_row], d_chunks[c][row], v_new, rng_states,
+                    v_max, p, stream=compute)
+
+        # Copying a full chunk back to the host, and the last one when done
+        if history is not None and (row == HISTORY_CHUNK - 1 or t == n_steps):
+            filled = cuda.event()
+            filled.record(compute)
+            filled.wait(copy)
+            d_chunks[c].copy_to_host(h_chunks[c], stream=copy)
+            done = cuda.event()
+            done.record(copy)
+            pending[c] = (done, t - row)
+
+    if history is not None:
+        flush(0)
+        flush(1)
+
+    c, row = divmod(n_steps, HISTORY_CHUNK)
+    compute.synchronize()
+    return d_chunks[c % 2][row].copy_to_host()
@@ -1,8 +1,340 @@
 # The base Nagel-Schreckenberg cellular automaton models.
 
 
+from collections import deque
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # Without Numba only the circular model is available, stepped by the ahead-of-time
+    #   compiled kernel built from _ns_kernel.pyx. The Numba kernels below are still
+    #   defined, as plain Python, but never run.
+    try:
+        from _ns_kernel import next_state_circular
+    except ImportError:
+        raise ImportError("nsmodel needs either Numba (pip install numba) or the ahead-of-time "
+                          "compiled kernel (python build_ns_kernel.py build_ext --inplace)."
+                          ) from None
+    njit = lambda *args, **kwargs: lambda function: function
+    prange = range
+    HAVE_NUMBA = False
+else:
+    HAVE_NUMBA = True
+
+
+# Lanes with at least this many cells use the multithreaded update kernel.
+PARALLEL_CELLS = 100_000
+
+# Random numbers are drawn in blocks of at most this many values.
+RAND_BLOCK_SIZE = 2**20
+
+# Equilibrium without a given t0 samples the mean car velocity every EQUILIBRIUM_CHECK
+#   steps, and stops once the last EQUILIBRIUM_WINDOW samples have settled. Jams take
+#   a time proportional to the lane length to coarsen, so longer lanes sample less 
+#   often, for the window to span at least EQUILIBRIUM_SPAN * cells steps.
+EQUILIBRIUM_CHECK = 10
+EQUILIBRIUM_WINDOW = 50
+EQUILIBRIUM_SPAN = 5
+
+
+# Lowest bit of each byte of a 64-bit word.
+_LOW_BITS = np.uint64(0x0101010101010101)
+
+
+@njit(cache=True)
+def _randomize_swar(v_new, rand_mask, n_cars):
+    """
+    Apply the randomization step to the first n_cars velocities in v_new, eight cars
+    at a time. Each velocity is one byte lane of a uint64 word and is decreased by 
+    one, without branching, where its rand_mask byte is 1 and the velocity is positive.
+    Both arrays need a length that is a multiple of 8.
+    """
+    n_words = (n_cars + 7) // 8
+    v_new[n_cars:8 * n_words] = 0
+    rand_mask[n_cars:8 * n_words] = 0
+    words = v_new.view(np.uint64)
+    masks = rand_mask.view(np.uint64)
+    for w in range(n_words):
+        x = words[w]
+        # Lowest bit of each lane set where the velocity (0 to 127) is nonzero
+        nz = x
+        for shift in range(1, 7):
+            nz |= x >> np.uint64(shift)
+        words[w] = x - (masks[w] & nz & _LOW_BITS)
+
+
+def _next_state_circular_impl(state, next_state, car_indices, gaps, v_new, rand_mask, 
+                              v_max, p, rand_u01):
+    """
+    Compute the next state of the circular, closed system into next_state, using
+    scalar passes over the cars. car_indices, gaps, v_new and rand_mask are scratch 
+    space of length cells rounded up to a multiple of 8, and rand_u01 holds one 
+    uniform random number per car, so its length must be the number of cars in state.
+    """
+    cells = state.shape[0]
+    n_cars = rand_u01.shape[0]
+    next_state[:] = -1
+    if n_cars == 0:
+        return
+
+    # Finding the first car, which the last car wraps around to
+    first = 0
+    while state[first] == -1:
+        first += 1
+
+    # One reverse sweep from the end of the lane back to the first car finds every 
+    #   car and its distance to the next car ahead
+    next_car = first + cells
+    k = n_cars
+    for i in range(cells - 1, first - 1, -1):
+        if state[i] > -1:
+            k -= 1
+            car_indices[k] = i
+            gaps[k] = next_car - i
+            next_car = i
+
+    # Each car only reads its own gap, so the cars can be updated independently
+    #   once the gaps are known.
+    for k in prange(n_cars):
+        gap = gaps[k]
+
+        # Step 1: Acceleration
+        v = state[car_indices[k]]
+        if v < v_max and v + 1 < gap:
+            v += 1
+
+        # Step 2: Slowing Down
+        if v >= gap:
+            v = gap - 1
+
+        v_new[k] = v
+        rand_mask[k] = rand_u01[k] < p
+
+    # Step 3: Randomization
+    _randomize_swar(v_new, rand_mask, n_cars)
+
+    # Step 4: Car Motion
+    for k in prange(n_cars):
+        idx = car_indices[k] + v_new[k]
+        if idx >= cells:
+            idx -= cells
+        next_state[idx] = v_new[k]
+
+
+_next_state_circular = njit(cache=True)(_next_state_circular_impl)
+# Not cached, as both variants of the same function would share one cache entry.
+_next_state_circular_par = njit(parallel=True)(_next_state_circular_impl)
+
+
+@njit(cache=True)
+def _next_state_bottleneck(state, next_state, car_indices, v_new, rand_mask, v_max, v_max_bn, 
+                           bn_start, bn_end, p, inflow, rand_u01, inflow_u01):
+    """
+    Compute the next state of the open-boundary system into next_state, using scalar
+    passes over the cars. car_indices, v_new and rand_mask are scratch space of length
+    cells rounded up to a multiple of 8, rand_u01 holds one uniform random number per 
+    cell, and inflow_u01 decides the inflow.
+    """
+    cells = state.shape[0]
+
+    # One reverse sweep over the lane finds every car, from the lead car backwards,
+    #   along with its distance to the car ahead, and applies steps 1 and 2 to it.
+    n_cars = 0
+    next_car = cells
+    for i in range(cells - 1, -1, -1):
+        if state[i] == -1:
+            continue
+
+        # The lead car always sees an open road ahead.
+        if n_cars == 0:
+            gap = v_max + 1
+        else:
+            gap = next_car - i
+        next_car = i
+
+        # Applying v_max if the car is outside the bottleneck, and v_max_bn inside it.
+        if bn_start <= i <= bn_end:
+            v_local = v_max_bn
+        else:
+            v_local = v_max
+
+        # Step 1: Acceleration
+        v = state[i]
+        if v < v_local:
+            v += 1
+
+        # Step 2: Slowing down
+        if v >= gap:
+            v = gap - 1
+        if v < 0:
+            v = 0
+
+        car_indices[n_cars] = i
+        v_new[n_cars] = v
+        rand_mask[n_cars] = rand_u01[i] < p
+        n_cars += 1
+
+    # Step 3: Randomization
+    _randomize_swar(v_new, rand_mask, n_cars)
+
+    # Step 4: Car Motion, cars passing the last cell leave the system
+    next_state[:] = -1
+    for k in range(n_cars):
+        idx = car_indices[k] + v_new[k]
+        if idx < cells:
+            next_state[idx] = v_new[k]
+
+    # Applying inflow at the left-most cell
+    if next_state[0] == -1 and inflow_u01 < inflow:
+        next_state[0] = 0
+
+
+@njit(cache=True)
+def _simulate_circular(history, start, rand_u01, car_indices, gaps, v_new, rand_mask, v_max, p):
+    """
+    Iterate the circular system for len(rand_u01) steps, starting from history[start] 
+    and writing the state after history[t] into history[t + 1]. Rows are reused 
+    cyclically when history is too short, so two rows are enough to run without 
+    recording. Row t of rand_u01 holds the random numbers for step t. Returns the row 
+    index holding the final state.
+    """
+    rows = history.shape[0]
+    cells = history.shape[1]
+    n_steps = rand_u01.shape[0]
+    for t in range(start, start + n_steps):
+        if cells >= PARALLEL_CELLS:
+            _next_state_circular_par(history[t % rows], history[(t + 1) % rows], 
+                                     car_indices, gaps, v_new, rand_mask, v_max, p, 
+                                     rand_u01[t - start])
+        else:
+            _next_state_circular(history[t % rows], history[(t + 1) % rows], 
+                                 car_indices, gaps, v_new, rand_mask, v_max, p, 
+                                 rand_u01[t - start])
+    return (start + n_steps) % rows
+
+
+@njit(cache=True)
+def _simulate_bottleneck(history, start, rand_u01, car_indices, v_new, rand_mask, v_max, 
+                         v_max_bn, bn_start, bn_end, p, inflow):
+    """
+    Iterate the open-boundary system for len(rand_u01) steps, with the same use of 
+    history as _simulate_circular. The last column of rand_u01 decides the inflow.
+    Returns the row index holding the final state.
+    """
+    rows = history.shape[0]
+    cells = history.shape[1]
+    n_steps = rand_u01.shape[0]
+    for t in range(start, start + n_steps):
+        _next_state_bottleneck(history[t % rows], history[(t + 1) % rows], car_indices, 
+                               v_new, rand_mask, v_max, v_max_bn, bn_start, bn_end, p, 
+                               inflow, rand_u01[t - start], rand_u01[t - start, cells])
+    return (start + n_steps) % rows
+
+
+@njit(cache=True)
+def _next_state_ensemble(state, next_state, cars, active, rand_u01, v_max, p):
+    """
+    Compute the next state of every circular lane in state, with shape (lanes, cells),
+    into next_state. Steps 1-4 are fused into one reverse sweep per lane, which finds
+    each car's distance to the car ahead and moves the car straight away. cars holds
+    the number of cars in each lane, and rand_u01[lane, k] is the uniform random
+    number of the k-th car of the lane. Lanes where active is False are copied
+    unchanged.
+    """
+    lanes, cells = state.shape
+    next_state[:] = -1
+    for lane in range(lanes):
+        if not active[lane]:
+            next_state[lane] = state[lane]
+            continue
+        if cars[lane] == 0:
+            continue
+
+        # Finding the first car, which the last car wraps around to
+        first = 0
+        while state[lane, first] == -1:
+            first += 1
+
+        next_car = first + cells
+        k = cars[lane]
+        for i in range(cells - 1, first - 1, -1):
+            v = state[lane, i]
+            if v == -1:
+                continue
+            k -= 1
+            gap = next_car - i
+            next_car = i
+
+            # Step 1: Acceleration
+            if v < v_max and v + 1 < gap:
+                v += 1
+
+            # Step 2: Slowing Down
+            if v >= gap:
+                v = gap - 1
+
+            # Step 3: Randomization
+            if v > 0 and rand_u01[lane, k] < p:
+                v -= 1
+
+            # Step 4: Car Motion, into the separate next_state so the sweep still
+            #   reads the current positions
+            idx = i + v
+            if idx >= cells:
+                idx -= cells
+            next_state[lane, idx] = v
+
+
+@njit(cache=True)
+def _simulate_ensemble(history, start, rand_u01, cars, active, v_max, p):
+    """
+    Iterate the ensemble for len(rand_u01) steps, with the same use of history as 
+    _simulate_circular. Row t of rand_u01 holds the random numbers of every lane for
+    step t. Returns the row index holding the final state.
+    """
+    rows = history.shape[0]
+    n_steps = rand_u01.shape[0]
+    for t in range(start, start + n_steps):
+        _next_state_ensemble(history[t % rows], history[(t + 1) % rows], cars, active,
+                             rand_u01[t - start], v_max, p)
+    return (start + n_steps) % rows
+
+
+def _reserve(buffer, filled, rows):
+    """
+    Return buffer if it has at least rows rows, otherwise a larger buffer holding a 
+    copy of its first filled rows. Grows geometrically, so that repeated calls only
+    copy each row a constant number of times on average.
+    """
+    if len(buffer) >= rows:
+        return buffer
+    grown = np.empty((max(rows, 2 * len(buffer)),) + buffer.shape[1:], buffer.dtype)
+    grown[:filled] = buffer[:filled]
+    return grown
+
+
+def _equilibrium_check(cells):
+    """
+    The number of steps between mean velocity samples while reaching equilibrium in a
+    lane of the given length.
+    """
+    return max(EQUILIBRIUM_CHECK, EQUILIBRIUM_SPAN * cells // EQUILIBRIUM_WINDOW)
+
+
+def _settled(samples):
+    """
+    Whether a window of mean velocity samples has stopped drifting, meaning the means
+    of its older and newer halves differ by less than their standard error. Samples 
+    with more than one dimension are tested separately along the first axis.
+    """
+    samples = np.asarray(samples)
+    half = len(samples) // 2
+    older, newer = samples[:half], samples[half:]
+    drift = abs(newer.mean(axis=0) - older.mean(axis=0))
+    return drift <= np.sqrt((older.var(axis=0) + newer.var(axis=0)) / half)
+
 
 class TrafficModelCircular:
     """
@@ -18,8 +350,8 @@ class TrafficModelCircular:
         p (float): Probability factor for random decceleration events. Float must 
             be between 0 and 1.
         t0 (int): Initial number of timesteps to run the system through to reach a 
-            state of equilibrium before data collection starts. If None, 10 * cells 
-            is used.
+            state of equilibrium before data collection starts. If None, the system 
+            runs until the mean car velocity settles, for at most 10 * cells steps.
         random_state (None or int): The seed for the random number generator. If None,
             the random number generator is not seeded.
         initial_state (None or array): The initial state of the system. If None, a 
@@ -36,72 +368,186 @@ class TrafficModelCircular:
         self.p = p
 
         self.random_state = random_state
-        np.random.seed(random_state)
+        self.rng = np.random.default_rng(random_state)
 
-        # The system is a 1D array of integers, with -1 representing empty cells.
+        # The system is a 1D array of 8-bit integers, with -1 representing empty cells.
         #   Cars start with velocity of 0.
         if initial_state is None:
-            state = np.full(cells, -1, int)
-            car_indices = np.random.choice(cells, cars, replace=False)
+            state = np.full(cells, -1, np.int8)
+            car_indices = self.rng.choice(cells, cars, replace=False)
             state[car_indices] = 0
             self.initial_state = state
         
         else:
             if len(initial_state) != cells:
                 raise IndexError("Initial state must be consistent with system paramenters.")
-            self.initial_state = initial_state
+            self.initial_state = np.asarray(initial_state, np.int8)
+            self.cars = np.count_nonzero(self.initial_state > -1)
         
         self.state = self.initial_state
+        self._alloc(cells)
         self.initial_equilibrium(t0)
-        self.history = [self.state]  # History starts saving after equilibrium
+        # History starts saving after equilibrium, into a buffer that simulate grows
+        self._history[0] = self.state
+        self._steps = 1
 
+    def _alloc(self, cells):
+        """
+        Allocate the buffers reused by every run of the system: scratch space for the 
+        compiled kernels, padded for the 8-car randomization step, and the equilibrium 
+        and history buffers.
+        """
+        padded = -(-cells // 8) * 8
+        self._car_indices = np.empty(padded, np.int32)
+        self._gaps = np.empty(padded, np.int32)
+        self._v_new = np.empty(padded, np.int8)
+        self._rand_mask = np.empty(padded, np.uint8)
+        self._equilibrium = np.empty((2, cells), np.int8)
+        self._history = np.empty((1, cells), np.int8)
+
+    def reset(self, cars, t0=None, initial_state=None):
+        """
+        Restart the system with a new number of cars, reusing the allocated buffers, 
+        and clear the history. As in a new model, cars are placed randomly with 
+        velocity 0, unless initial_state is given, which then also sets the number 
+        of cars.
+        """
+        if cars > self.cells:
+            raise ValueError("Number of cars cannot exceed total cells in the system.")
+        if cars < 0:
+            raise ValueError("Number of cars cannot be negative.")
+
+        if initial_state is None:
+            state = np.full(self.cells, -1, np.int8)
+            state[self.rng.choice(self.cells, cars, replace=False)] = 0
+        else:
+            if len(initial_state) != self.cells:
+                raise IndexError("Initial state must be consistent with system paramenters.")
+            state = np.asarray(initial_state, np.int8)
+            cars = np.count_nonzero(state > -1)
+
+        self.cars = cars
+        self.initial_state = state
+        self.state = state
+        self.initial_equilibrium(t0)
+        self._history[0] = self.state
+        self._steps = 1
+
+    @property
+    def history(self):
+        """
+        The recorded states as an array of shape (timesteps, cells), starting after 
+        equilibrium. This is a view into the preallocated history buffer.
+        """
+        return self._history[:self._steps]
 
     def initial_equilibrium(self, t0):
         """
         Run the system through t0 time steps to reach an initial point of equilibrium,
-        after which data collection starts.
+        after which data collection starts. If t0 is None, the system runs until the
+        mean car velocity stops fluctuating, for at most 10 * cells steps, and 
+        stationary systems are not run at all.
+        """
+        buffer = self._equilibrium
+        buffer[0] = self.state
+        if t0 != None:
+            last = self._run(buffer, t0)
+            self.state = buffer[last]
+            return
+        if self._is_stationary():
+            return
+
+        # Sampling the mean velocity every check steps. Each run starts from 
+        #   buffer[0], so the final state of the last run is moved back there.
+        recent = deque(maxlen=EQUILIBRIUM_WINDOW)
+        check = _equilibrium_check(self.cells)
+        t0 = 10 * self.cells
+        for start in range(0, t0, check):
+            last = self._run(buffer, min(check, t0 - start))
+            buffer[0] = buffer[last]
+            velocities = buffer[0][buffer[0] > -1]
+            recent.append(velocities.mean() if len(velocities) else 0.0)
+            if len(recent) == EQUILIBRIUM_WINDOW and _settled(recent):
+                break
+        self.state = buffer[0]
+
+    def _is_stationary(self):
         """
-        if t0 == None:
-            t0 = 10 * self.cells
-        for i in range(t0):
-            self.state = self.next_state()
+        Whether the state can't change, which for the circular system is when the lane
+        is empty or full.
+        """
+        return np.count_nonzero(self.state > -1) in (0, self.cells)
 
     def simulate(self, n_steps):
         """
         Iterate the dynamics for n_steps, and return the results as an array.
         """
-        for i in range(n_steps):
-            self.state = self.next_state()
-            self.history.append(self.state)
+        start = self._steps - 1
+        self._history = _reserve(self._history, self._steps, self._steps + n_steps)
+        # Continuing from the current state, which may have been assigned directly
+        self._history[start] = self.state
+        self._run(self._history[start:start + n_steps + 1], n_steps)
+
+        self._steps += n_steps
+        self.state = self._history[self._steps - 1]
         return self.state
+
+    def _run(self, history, n_steps):
+        """
+        Iterate the dynamics for n_steps in compiled code, starting from history[0].
+        Random numbers are drawn in blocks of several timesteps at once. Returns the
+        row index of history holding the final state.
+        """
+        if not HAVE_NUMBA:
+            return self._run_aot(history, n_steps)
+        width = self._rand_width(history[0])
+        block = max(1, RAND_BLOCK_SIZE // max(width, 1))
+        last = 0
+        for start in range(0, n_steps, block):
+            rand_u01 = self.rng.random((min(block, n_steps - start), width), np.float32)
+            last = self._run_block(history, start, rand_u01)
+        return last
+
+    def _run_aot(self, history, n_steps):
+        """
+        Iterate the dynamics for n_steps with the ahead-of-time compiled kernel, which 
+        is used without Numba. Every step seeds the kernel's generator from self.rng. 
+        Returns the row index of history holding the final state.
+        """
+        rows = len(history)
+        seeds = self.rng.integers(2**63, size=n_steps)
+        for t in range(n_steps):
+            history[(t + 1) % rows] = next_state_circular(history[t % rows], self.v_max, 
+                                                          self.p, int(seeds[t]))
+        return n_steps % rows
+
+    def _rand_width(self, state):
+        """
+        The number of random numbers used per timestep from state, one per car. The
+        number of cars in the circular system is constant, so it is counted once per
+        run rather than trusting self.cars, which an assigned state can contradict.
+        """
+        return np.count_nonzero(state > -1)
+
+    def _run_block(self, history, start, rand_u01):
+        """
+        Iterate the dynamics for one block of random numbers, see _simulate_circular.
+        """
+        return _simulate_circular(history, start, rand_u01, self._car_indices, self._gaps, 
+                                  self._v_new, self._rand_mask, self.v_max, self.p)
     
     def next_state(self):
         """
         Compute the next state of the circular, closed system.
         """
-        # Finding distances between cars
-        car_indices = np.asarray(self.state > -1).nonzero()[0]  # need to select 0 index to avoid tuple
-        d_next_car = np.roll(car_indices, -1)
-        d_next_car[-1] += self.cells
-        d_next_car -= car_indices
-
-        # Step 1: Acceleration
-        v_cars = self.state[car_indices]
-        v_accel = np.where((v_cars < self.v_max) & (v_cars + 1 < d_next_car), 
-                     v_cars + 1, v_cars)
-
-        # Step 2: Slowing Down
-        v_deccel = np.where(v_accel >= d_next_car, d_next_car - 1, v_accel)
-
-        # Step 3: Randomization
-        rand_cars = np.random.choice(2, size=len(car_indices), p=[1-self.p, self.p])
-        v_rand = np.where(rand_cars & (v_deccel > 0), v_deccel - 1, v_deccel)
-
-        # Step 4: Car Motion
-        car_indices += v_rand
-        car_indices = np.where(car_indices < self.cells, car_indices, car_indices - self.cells)
-        next_state_arr = np.full(self.cells, -1, int)
-        next_state_arr[car_indices] = v_rand
+        if not HAVE_NUMBA:
+            return next_state_circular(self.state, self.v_max, self.p, 
+                                       int(self.rng.integers(2**63)))
+        next_state_arr = np.empty_like(self.state)
+        rand_u01 = self.rng.random(self._rand_width(self.state), np.float32)
+        step = _next_state_circular_par if self.cells >= PARALLEL_CELLS else _next_state_circular
+        step(self.state, next_state_arr, self._car_indices, self._gaps, self._v_new, 
+             self._rand_mask, self.v_max, self.p, rand_u01)
 
         return next_state_arr
     
@@ -121,7 +567,7 @@ class TrafficBottleneck(TrafficModelCircular):
         v_max (int): The maximum velocity for cars outside the bottleneck.
         p (float): The natural breaking probability used in the NS model.
         t0 (int): The number of initial time steps to run to reach equilibrium before recording data.
-            If None, defaults to 10 * cells.
+            If None, runs until the mean car velocity settles, for at most 10 * cells steps.
         random_state (int): The seed for NumPy's random number generator. If None, the random number
             generator is not seeded.
         initial_state (array): The initial configuration of the system. If None, cars are placed
@@ -137,6 +583,9 @@ class TrafficBottleneck(TrafficModelCircular):
     def __init__(self, cars, cells=100, v_max=5, p=0.5, t0=None, random_state=None, 
                  initial_state=None, bn_start=None, bn_end=None, v_max_bn=1, inflow=0.5):
 
+        if not HAVE_NUMBA:
+            raise ImportError("The bottleneck model needs Numba.")
+
         # Extra bottleneck parameters
         self.bn_start = bn_start
         self.bn_end = bn_end
@@ -152,59 +601,225 @@ class TrafficBottleneck(TrafficModelCircular):
             To compute the next state of each car according to the 4-step rule of the NS model
             for an open-boundary system with a bottleneck region.
         """
-        state = self.state
-        cells = self.cells
-        p = self.p
+        next_state_arr = np.empty_like(self.state)
+        rand_u01 = self.rng.random(self._rand_width(self.state), np.float32)
+        bn_start, bn_end = self._bottleneck_region()
 
-        # Identifying where cars are in the traffic lane.
-        car_indices = np.asarray(state > -1).nonzero()[0]
-        next_state_arr = np.full(cells, -1, int)
+        _next_state_bottleneck(self.state, next_state_arr, self._car_indices, self._v_new, 
+                               self._rand_mask, self.v_max, self.v_max_bn, bn_start, bn_end, 
+                               self.p, self.inflow, rand_u01, rand_u01[-1])
 
-        # Checking for a special case of no cars on the road.
-        if len(car_indices) == 0:
-            if np.random.rand() < self.inflow:
-                next_state_arr[0] = 0
-            return next_state_arr
+        return next_state_arr
 
-        # Finding distance between the cars.
-        d_next_car = np.empty(len(car_indices), int)
+    def _is_stationary(self):
+        """
+        Whether the state can't change, which never holds with an open boundary.
+        """
+        return False
 
-        if len(car_indices) == 1:
-            d_next_car[0] = self.v_max + 1
-        else:
-            d_next_car[:-1] = car_indices[1:] - car_indices[:-1]
-            d_next_car[-1] = self.v_max + 1
+    def _rand_width(self, state):
+        """
+        The number of random numbers used per timestep, one per cell and one for the 
+        inflow.
+        """
+        return self.cells + 1
 
-        # Determining v_max of each car: applying v_max if the car is outside the bottlneck, and v_max_bn for cars inside it.
+    def _run_block(self, history, start, rand_u01):
+        """
+        Iterate the dynamics for one block of random numbers, see _simulate_bottleneck.
+        """
+        bn_start, bn_end = self._bottleneck_region()
+        return _simulate_bottleneck(history, start, rand_u01, self._car_indices, self._v_new, 
+                                    self._rand_mask, self.v_max, self.v_max_bn, bn_start, 
+                                    bn_end, self.p, self.inflow)
+
+    def _bottleneck_region(self):
+        """
+        The first and last cell of the bottleneck region. A region of [-1, -1] never
+        contains a car, which is used when there is no bottleneck.
+        """
         if self.bn_start is None:
-            v_local = np.full(len(car_indices), self.v_max)
+            return -1, -1
+        return self.bn_start, self.bn_end
+
+
+class TrafficEnsembleCircular:
+    """
+    An ensemble of independent circular Nagel–Schreckenberg traffic lanes of equal
+    length, simulated together. The lanes are stored as one 2D array of shape 
+    (lanes, cells), and every step updates all lanes in one compiled call.
+
+    Parameters:
+        cars (array of ints): The number of cars in each lane. Its length sets the 
+            number of lanes. No entry can be greater than the number of cells.
+        cells (int): The number of cells in each traffic lane, which can be occupied 
+            by 0 or 1 car.
+        v_max (int): Speed limit of the traffic system.
+        p (float): Probability factor for random decceleration events. Float must 
+            be between 0 and 1.
+        t0 (int): Initial number of timesteps to run the system through to reach a 
+            state of equilibrium before data collection starts. If None, the ensemble
+            runs until the mean car velocity of every lane settles, for at most 
+            10 * cells steps.
+        random_state (None or int): The seed for the random number generator. If None,
+            the random number generator is not seeded. Each lane draws from its own
+            stream spawned from this seed, so a lane's results don't depend on the 
+            number of lanes.
+        initial_state (None or array): The initial state of the system, with shape 
+            (lanes, cells). If None, a random initial state is used.
+        use_gpu (bool): Run the simulation on a CUDA GPU, using the kernels in nsgpu.py.
+            The GPU draws its own random numbers, so results differ from the CPU run
+            with the same random_state.
+    """
+    def __init__(self, cars, cells=100, v_max=5, p=0.5, t0=None, random_state=None, initial_state=None,
+                 use_gpu=False):
+        if not HAVE_NUMBA:
+            raise ImportError("The ensemble needs Numba.")
+        cars = np.asarray(cars, int)
+        if np.any(cars > cells):
+            raise ValueError("Number of cars cannot exceed total cells in the system.")
+        self.cells = cells
+        self.lanes = len(cars)
+        self.v_max = v_max
+        self.p = p
+
+        self.random_state = random_state
+        seed_sequence = np.random.SeedSequence(random_state)
+        self.rng = np.random.default_rng(seed_sequence)
+        # Independent random number streams for each lane
+        self.lane_rngs = [np.random.default_rng(seed) for seed in seed_sequence.spawn(self.lanes)]
+
+        # Each lane is a row of 8-bit integers, with -1 representing empty cells.
+        #   Cars start with velocity of 0.
+        if initial_state is None:
+            state = np.full((self.lanes, cells), -1, np.int8)
+            for lane in range(self.lanes):
+                state[lane, self.lane_rngs[lane].choice(cells, cars[lane], replace=False)] = 0
+            self.initial_state = state
+
         else:
-            in_bn = (car_indices >= self.bn_start) & (car_indices <= self.bn_end)
-            v_local = np.where(in_bn, self.v_max_bn, self.v_max)
+            if np.shape(initial_state) != (self.lanes, cells):
+                raise IndexError("Initial state must be consistent with system paramenters.")
+            self.initial_state = np.asarray(initial_state, np.int8)
+            cars = np.count_nonzero(self.initial_state > -1, axis=1)
 
-        v_cars = state[car_indices]
+        self.cars = cars
+        self.state = self.initial_state
 
-        # Step 1: Acceleration
-        v_accel = np.where(v_cars < v_local, v_cars + 1, v_cars)
+        self.use_gpu = use_gpu
+        if use_gpu:
+            from nsgpu import create_rng_states
+            self._rng_states = create_rng_states(self.lanes, cells, int(self.rng.integers(2**63)))
 
-        # Step 2: Slowing down
-        v_decel = np.where(v_accel >= d_next_car, d_next_car - 1, v_accel)
-        v_decel = np.maximum(v_decel, 0)
+        self.initial_equilibrium(t0)
+        # History starts saving after equilibrium, into a buffer that simulate grows
+        self._history = self.state[np.newaxis].copy()
+        self._steps = 1
 
-        # Step 3: Randomization
-        rand_cars = np.random.rand(len(car_indices)) < p
-        v_rand = np.where(rand_cars & (v_decel > 0), v_decel - 1, v_decel)
+    @property
+    def history(self):
+        """
+        The recorded states as an array of shape (timesteps, lanes, cells), starting 
+        after equilibrium. This is a view into the preallocated history buffer.
+        """
+        return self._history[:self._steps]
 
-        # Step 4: Car Motion
-        new_positions = car_indices + v_rand
-        valid = new_positions < cells
-        new_positions = new_positions[valid]
-        new_velocities = v_rand[valid]
+    def initial_equilibrium(self, t0):
+        """
+        Run the system through t0 time steps to reach an initial point of equilibrium,
+        after which data collection starts. If t0 is None, the ensemble runs until the
+        mean car velocity of every lane stops fluctuating, for at most 10 * cells 
+        steps, and stationary ensembles are not run at all.
+        """
+        if t0 != None:
+            self.state = self._advance(t0)
+            return
+        cars = np.count_nonzero(self.state > -1, axis=1)
+        if np.all((cars == 0) | (cars == self.cells)):
+            return
+
+        # Sampling the mean velocity of every lane each check steps, with empty lanes 
+        #   at 0. A lane is frozen from the first window that passes, as 
+        #   a single lane would have stopped there, so its result doesn't depend on 
+        #   the other lanes.
+        recent = deque(maxlen=EQUILIBRIUM_WINDOW)
+        settled = np.zeros(self.lanes, bool)
+        check = _equilibrium_check(self.cells)
+        t0 = 10 * self.cells
+        for start in range(0, t0, check):
+            self.state = self._advance(min(check, t0 - start), ~settled)
+            speed = np.where(self.state > -1, self.state, 0).sum(axis=1)
+            recent.append(speed / np.maximum(cars, 1))
+            if len(recent) == EQUILIBRIUM_WINDOW:
+                settled |= _settled(recent)
+                if settled.all():
+                    break
+
+    def _advance(self, n_steps, active=None):
+        """
+        Iterate the dynamics for n_steps without recording, and return the final state.
+        Only the lanes where active is True are stepped, or every lane if it is None.
+        """
+        if self.use_gpu:
+            from nsgpu import simulate_gpu
+            state = simulate_gpu(self.state, n_steps, self._rng_states, self.v_max, self.p)
+            if active is not None:
+                state[~active] = self.state[~active]
+            return state
+        buffer = np.empty((2,) + self.state.shape, np.int8)
+        buffer[0] = self.state
+        last = self._run(buffer, n_steps, active)
+        return buffer[last]
+
+    def simulate(self, n_steps):
+        """
+        Iterate the dynamics for n_steps, and return the results as an array. The
+        history has shape (timesteps, lanes, cells).
+        """
+        start = self._steps - 1
+        self._history = _reserve(self._history, self._steps, self._steps + n_steps)
+        history = self._history
+        history[start] = self.state
+        if self.use_gpu:
+            from nsgpu import simulate_gpu
+            simulate_gpu(self.state, n_steps, self._rng_states, self.v_max, self.p,
+                         history=history[start:start + n_steps + 1])
+        else:
+            self._run(history[start:start + n_steps + 1], n_steps)
 
-        next_state_arr[new_positions] = new_velocities
+        self._steps += n_steps
+        self.state = history[self._steps - 1]
+        return self.state
 
-        # Applying inflow at the left-most cell
-        if next_state_arr[0] == -1 and np.random.rand() < self.inflow:
-            next_state_arr[0] = 0
+    def _run(self, history, n_steps, active=None):
+        """
+        Iterate the dynamics for n_steps in compiled code, starting from history[0].
+        Each lane draws one random number per car and step from its own stream, in 
+        blocks of several timesteps at once. Only the lanes where active is True are 
+        stepped and draw random numbers, or every lane if it is None. Returns the row 
+        index of history holding the final state.
+        """
+        if active is None:
+            active = np.ones(self.lanes, bool)
+        cars = np.count_nonzero(history[0] > -1, axis=1)
+        width = max(cars.max(), 1)
+        block = max(1, RAND_BLOCK_SIZE // (self.lanes * width))
+        rand_u01 = np.empty((min(block, n_steps), self.lanes, width), np.float32)
+        last = 0
+        for start in range(0, n_steps, block):
+            steps = min(block, n_steps - start)
+            for lane in np.flatnonzero(active):
+                rand_u01[:steps, lane, :cars[lane]] = self.lane_rngs[lane].random(
+                    (steps, cars[lane]), np.float32)
+            last = _simulate_ensemble(history, start, rand_u01[:steps], cars, active, 
+                                      self.v_max, self.p)
+        return last
 
-        return next_state_arr
+    def next_state(self):
+        """
+        Compute the next state of every lane in the ensemble.
+        """
+        buffer = np.empty((2,) + self.state.shape, np.int8)
+        buffer[0] = self.state
+        self._run(buffer, 1)
+        return buffer[1]
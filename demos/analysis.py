@@ -8,6 +8,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 
+# Number of set bits in each possible byte, for counting packed occupancy bits.
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
 
 
 def SpaceTimePlot(cells, system_density, timesteps, bottleneck=False,
@@ -37,8 +40,8 @@ def SpaceTimePlot(cells, system_density, timesteps, bottleneck=False,
         p (float): Probability factor for random decceleration events. Float must 
             be between 0 and 1.
         t0 (int): Initial number of timesteps to run the system through to reach a 
-            state of equilibrium before data collection starts. If None, 10 * cells 
-            is used.
+            state of equilibrium before data collection starts. If None, the system 
+            runs until the mean car velocity settles, for at most 10 * cells steps.
         initial_state (None or array): The initial state of the system. If None, a 
             random initial state is used.
 
@@ -61,10 +64,12 @@ def SpaceTimePlot(cells, system_density, timesteps, bottleneck=False,
         model = TrafficModelCircular(cars, cells, v_max, p, t0, random_state, initial_state)
    
     model.simulate(timesteps)
-    data = np.asarray(model.history)
+    data = model.history
 
     fig, ax = plt.subplots(figsize=(0.12*cells, timesteps//10), dpi=300)
-    im = ax.imshow(data, cmap='Greys')
+    # Plotting the int8 history directly, with a fixed velocity range instead of one 
+    #   found by scanning the data
+    im = ax.imshow(data, cmap='Greys', vmin=-1, vmax=v_max, interpolation='nearest')
 
     ax.tick_params(axis='x', labelsize=8)
     ax.tick_params(axis='y', labelsize=8)
@@ -118,8 +123,8 @@ def DensityFlowResults(cells, system_density, timesteps, bottleneck=False,
         p (float): Probability factor for random decceleration events. Float must 
             be between 0 and 1.
         t0 (int): Initial number of timesteps to run the system through to reach a 
-            state of equilibrium before data collection starts. If None, 10 * cells 
-            is used.
+            state of equilibrium before data collection starts. If None, the system 
+            runs until the mean car velocity settles, for at most 10 * cells steps.
         initial_state (None or array): The initial state of the system. If None, a 
             random initial state is used.
 
@@ -139,20 +144,37 @@ def DensityFlowResults(cells, system_density, timesteps, bottleneck=False,
     else:
         model = TrafficModelCircular(cars, cells, v_max, p, t0, random_state, initial_state)
 
-    model = TrafficModelCircular(cars, cells, v_max, p, t0, random_state, initial_state)
     model.simulate(timesteps)
-    history = np.asarray(model.history)
+    history = model.history
 
     sample_indices = np.arange(first_sample, cells, sample_spacing)
+    return _density_flow(history, sample_indices, timesteps, v_max)
+
+
+
+
+
+def _density_flow(history, sample_indices, timesteps, v_max):
+    """
+    Measure the local density and flow at the sampled cell indices of a single lane's 
+    history, with shape (timesteps, cells). 
+    Output: a tuple of two 1d numpy arrays; ([density], [flow])
+    """
 
     transpose = history.T
-    occupy = np.where(transpose[sample_indices]>-1, 1, 0)
-    occupy_sum = np.sum(occupy, axis=1)
+    # Occupancy of each sampled cell packed into one bit per timestep
+    occupy_bits = np.packbits(transpose[sample_indices]>-1, axis=1)
+    occupy_sum = np.sum(_POPCOUNT[occupy_bits], axis=1)
     density = occupy_sum / timesteps
 
-    flow_conditions = [transpose[sample_indices-i]>i for i in range(v_max)]
-    flow = np.where(np.logical_or.reduce(flow_conditions), 1, 0)
-    flow = np.sum(flow, axis=1, dtype=float)
+    # Flow conditions for each sampled cell and the v_max - 1 cells behind it, compared
+    #   in one pass over a (samples, v_max, timesteps) slab, then packed the same way
+    #   and combined with a bitwise or
+    offsets = np.arange(v_max)
+    slab = transpose[sample_indices[:, np.newaxis] - offsets]
+    flow_conditions = np.packbits(slab > offsets[:, np.newaxis], axis=2)
+    flow_bits = np.bitwise_or.reduce(flow_conditions, axis=1)
+    flow = np.sum(_POPCOUNT[flow_bits], axis=1, dtype=float)
     flow /= timesteps
 
     return (density, flow)
@@ -193,8 +215,8 @@ def PlotDensityFlow(cells, timesteps, bottleneck=False, save_file_name="",
         p (float): Probability factor for random decceleration events. Float must 
             be between 0 and 1.
         t0 (int): Initial number of timesteps to run the system through to reach a 
-            state of equilibrium before data collection starts. If None, 10 * cells 
-            is used.
+            state of equilibrium before data collection starts. If None, the system 
+            runs until the mean car velocity settles, for at most 10 * cells steps.
         initial_state (None or array): The initial state of the system. If None, a 
             random initial state is used.
 
@@ -206,18 +228,53 @@ def PlotDensityFlow(cells, timesteps, bottleneck=False, save_file_name="",
             is empty.
     """
 
-    # cars = (np.asarray(densities) * cells).astype(int)
-    density_data = np.empty((2,))
-    flow_data = np.empty((2,))
-
-    for system_density in densities:
-        dens_temp, flow_temp = DensityFlowResults(cells, system_density, timesteps, bottleneck=bottleneck, 
-                                                random_state=random_state, sample_spacing=sample_spacing, 
-                                                first_sample=first_sample, v_max=v_max, p=p, t0=t0, 
-                                                initial_state=initial_state, bn_start=bn_start, bn_end=bn_end, 
-                                                v_max_bn=v_max_bn, inflow=inflow)
-        density_data = np.hstack((density_data.copy(), dens_temp.copy()))
-        flow_data = np.hstack((flow_data.copy(), flow_temp.copy()))
+    sample_indices = np.arange(first_sample, cells, sample_spacing)
+
+    if bottleneck:
+        dens_chunks = []
+        flow_chunks = []
+
+        # One model and its buffers are reused for every density, with each run
+        #   starting from initial_state when it is given
+        cars = (np.asarray(densities) * cells).astype(int)
+        model = TrafficBottleneck(cars[0], cells=cells, v_max=v_max, p=p, t0=t0, random_state=random_state, 
+                                  initial_state=initial_state, bn_start=bn_start, bn_end=bn_end, 
+                                  v_max_bn=v_max_bn, inflow=inflow)
+        for i, run_cars in enumerate(cars):
+            if i > 0:
+                model.reset(run_cars, t0=t0, initial_state=initial_state)
+            model.simulate(timesteps)
+            dens_temp, flow_temp = _density_flow(model.history, sample_indices, timesteps, v_max)
+            dens_chunks.append(dens_temp)
+            flow_chunks.append(flow_temp)
+
+        density_data = np.concatenate(dens_chunks)
+        flow_data = np.concatenate(flow_chunks)
+
+    else:
+        cars = (np.asarray(densities) * cells).astype(int)
+        if initial_state is not None:
+            initial_state = np.broadcast_to(initial_state, (len(cars), cells))
+        if HAVE_NUMBA:
+            # Every density is one lane of a single ensemble run
+            model = TrafficEnsembleCircular(cars, cells, v_max, p, t0, random_state, initial_state)
+            model.simulate(timesteps)
+            histories = [model.history[:, lane] for lane in range(model.lanes)]
+        else:
+            # Without Numba there is no ensemble, so each density runs as a single-lane 
+            #   model, seeded like the lanes of the ensemble
+            seeds = np.random.SeedSequence(random_state).spawn(len(cars))
+            histories = []
+            for lane, run_cars in enumerate(cars):
+                lane_state = None if initial_state is None else initial_state[lane]
+                model = TrafficModelCircular(run_cars, cells, v_max, p, t0, seeds[lane], lane_state)
+                model.simulate(timesteps)
+                histories.append(model.history)
+
+        results = [_density_flow(history, sample_indices, timesteps, v_max) 
+                   for history in histories]
+        density_data = np.concatenate([dens_temp for dens_temp, flow_temp in results])
+        flow_data = np.concatenate([flow_temp for dens_temp, flow_temp in results])
     
     plt.figure(dpi=300)
     plt.plot(density_data, flow_data, ".k", ms=3, alpha=0.5)